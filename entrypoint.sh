@@ -1,3 +1,6 @@
 #!/bin/bash
 
-uvicorn main:app --reload --host 0.0.0.0 --port 8000
\ No newline at end of file
+# Shared directory so /metrics aggregates across all uvicorn workers
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-$(mktemp -d)}"
+
+uvicorn main:app --host 0.0.0.0 --port 8000 --workers "$(nproc)" --loop uvloop --http httptools
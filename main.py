@@ -1,26 +1,56 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Form, Response
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import asyncio
+import hashlib
+import io
+import math
+import re
 import tempfile
+import threading
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+import functools
+from contextlib import contextmanager
+from typing import BinaryIO, List, Optional, Dict, Any, Union
 import logging
 from datetime import datetime
 
 from llama_index.core import Document, VectorStoreIndex, Settings, ServiceContext
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores import ExactMatchFilter, MetadataFilters
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.embeddings.gemini import GeminiEmbedding
 from llama_index.vector_stores.pinecone import PineconeVectorStore
 from llama_index.readers.file import (
-    PDFReader,
     DocxReader,
     UnstructuredReader,
     MarkdownReader,
 )
-from pinecone import Pinecone
+import fitz
+from pinecone import PineconeAsyncio
+from pinecone.grpc import PineconeGRPC as Pinecone
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
 from dotenv import load_dotenv
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
 import uuid
 
@@ -40,17 +70,103 @@ for var in required_env_vars:
     if not os.getenv(var):
         raise ValueError(f"Missing required environment variable: {var}")
 
-app = FastAPI(title="CaseforAI Backend", version="1.0.0")
+app = FastAPI(
+    title="CaseforAI Backend",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
+
+# Batching/concurrency settings for the ingest path
+EMBED_BATCH_SIZE = 100
+UPSERT_BATCH_SIZE = 100
+MAX_CONCURRENT_UPSERTS = 5
+
+# Shared executor for blocking I/O so handlers don't stall the event loop
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
 
-# Initialize embedding model
-embed_model = GeminiEmbedding(
-    model_name="models/gemini-embedding-001", api_key=os.getenv("GOOGLE_API_KEY")
+# Per-stage timing for the upload pipeline, logged and exported on /metrics
+STAGE_SECONDS = Histogram(
+    "upload_stage_seconds", "Duration of upload pipeline stages", ["stage"]
 )
+
+
+@contextmanager
+def timed(name: str):
+    """Log and record how long a pipeline stage took"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        logger.info("stage=%s ms=%.1f", name, elapsed * 1000)
+
+# Upload streaming settings: read in 1 MiB chunks, spill to disk past this
+# threshold so peak RSS stays bounded regardless of file size
+UPLOAD_CHUNK_SIZE = 1 << 20
+IN_MEMORY_MAX_BYTES = 16 * 1024 * 1024
+
+# gemini-embedding-001 is Matryoshka-trained: truncating its 3072-dim output
+# to 768 loses <1% recall while quartering index storage and query compute
+GEMINI_EMBED_DIM = 768
+
+
+def truncate_embedding(embedding: List[float]) -> List[float]:
+    """Keep the first GEMINI_EMBED_DIM dims and L2-renormalize"""
+    truncated = embedding[:GEMINI_EMBED_DIM]
+    norm = math.sqrt(sum(v * v for v in truncated))
+    if norm > 0:
+        truncated = [v / norm for v in truncated]
+    return truncated
+
+
+class TruncatedGeminiEmbedding(GeminiEmbedding):
+    """GeminiEmbedding with Matryoshka truncation on every embedding path"""
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return truncate_embedding(super()._get_query_embedding(query))
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return truncate_embedding(super()._get_text_embedding(text))
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [truncate_embedding(e) for e in super()._get_text_embeddings(texts)]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return truncate_embedding(await super()._aget_query_embedding(query))
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return truncate_embedding(await super()._aget_text_embedding(text))
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return [
+            truncate_embedding(e) for e in await super()._aget_text_embeddings(texts)
+        ]
+
+
+# Initialize embedding model. LOCAL_EMBED=1 swaps Gemini for a local GPU
+# model for bulk ingests — compute-bound on the card instead of one network
+# round-trip per batch. The Pinecone index dimension must match (384 for
+# bge-small); the startup check below catches any mismatch.
+if os.getenv("LOCAL_EMBED"):
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+    embed_model = HuggingFaceEmbedding(
+        model_name="BAAI/bge-small-en-v1.5",
+        device="cuda",
+        embed_batch_size=256,
+    )
+else:
+    embed_model = TruncatedGeminiEmbedding(
+        model_name="models/gemini-embedding-001",
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        embed_batch_size=EMBED_BATCH_SIZE,
+    )
 Settings.embed_model = embed_model
 
-# Initialize Pinecone with validation
+# Initialize Pinecone with validation (gRPC transport: faster upserts + lower query latency)
 try:
-    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"), pool_threads=32)
     pinecone_index = pc.Index("caseforai-embeddings")
 
     # Test connection and validate dimensions
@@ -90,6 +206,59 @@ Settings.node_parser = node_parser
 # Create global index instance
 index = VectorStoreIndex.from_vector_store(vector_store)
 
+# Keep the serverless index hot: the first query after idle pays a
+# cold-cache penalty while the pod loads the graph, so fire a tiny
+# warmup query now and again every 5 minutes
+WARMUP_INTERVAL_SECONDS = 300
+
+
+def warm_pinecone_cache():
+    try:
+        pinecone_index.query(vector=[0.0] * embedding_dim, top_k=1)
+    except Exception as e:
+        logger.warning(f"Pinecone warmup query failed: {str(e)}")
+    finally:
+        timer = threading.Timer(WARMUP_INTERVAL_SECONDS, warm_pinecone_cache)
+        timer.daemon = True
+        timer.start()
+
+
+warm_pinecone_cache()
+
+# Async Pinecone client for the request handlers: their network calls await
+# on the event loop instead of blocking it. The sync gRPC index above still
+# backs the LlamaIndex retriever wiring, startup checks and the warmup timer.
+async_pc = None
+async_index = None
+
+
+@app.on_event("startup")
+async def init_async_pinecone():
+    global async_pc, async_index
+    async_pc = PineconeAsyncio(api_key=os.getenv("PINECONE_API_KEY"))
+    host = pc.describe_index("caseforai-embeddings").host
+    async_index = async_pc.IndexAsyncio(host=host)
+    logger.info("✅ Async Pinecone client initialized")
+
+
+@app.on_event("shutdown")
+async def close_async_pinecone():
+    if async_index is not None:
+        await async_index.close()
+    if async_pc is not None:
+        await async_pc.close()
+
+# S3 bucket name - using the exact env var from .env file
+S3_BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME", "caseforai-bucket")
+
+# Multipart transfer settings: anything over 8MB uploads in parallel parts
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    max_concurrency=10,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=True,
+)
+
 # Initialize S3 client
 try:
     s3_client = boto3.client(
@@ -99,42 +268,75 @@ try:
         region_name=os.getenv(
             "AWS_REGION", "us-east-1"
         ),  # Default to us-east-1 if not specified
+        # Default pool is 10 connections; concurrent uploads and the
+        # chunk-text Range GETs queue behind it without a larger pool
+        config=BotoConfig(
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            retries={"max_attempts": 5, "mode": "adaptive"},
+        ),
     )
 
-    # Test S3 connection
-    s3_client.list_buckets()
+    # Test S3 connection (head_bucket is cheaper and scoped to our bucket,
+    # unlike list_buckets which needs s3:ListAllMyBuckets)
+    s3_client.head_bucket(Bucket=S3_BUCKET_NAME)
     logger.info("✅ S3 client initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize S3 client: {str(e)}")
     raise e
 
-# S3 bucket name - using the exact env var from .env file
-S3_BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME", "caseforai-bucket")
+
+def generate_s3_key(filename: str) -> str:
+    """Generate a unique S3 key with date prefix and UUID"""
+    timestamp = datetime.now().strftime("%Y/%m/%d")
+    unique_id = str(uuid.uuid4())[:8]
+    return f"documents/{timestamp}/{unique_id}_{filename}"
 
 
-def upload_file_to_s3(file_content: bytes, filename: str, content_type: str) -> str:
-    """Upload file to S3 and return the URL"""
+def s3_url_for_key(s3_key: str) -> str:
+    return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+
+
+def s3_object_exists(s3_key: str) -> bool:
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
+        return True
+    except ClientError:
+        return False
+
+
+def upload_file_to_s3(
+    file_content: Union[bytes, BinaryIO],
+    filename: str,
+    content_type: str,
+    upload_timestamp: Optional[str] = None,
+    s3_key: Optional[str] = None,
+) -> str:
+    """Upload file content (bytes or a binary file object) to S3 and return the URL"""
     try:
-        # Generate unique key with timestamp and UUID
-        timestamp = datetime.now().strftime("%Y/%m/%d")
-        unique_id = str(uuid.uuid4())[:8]
-        file_extension = Path(filename).suffix
-        s3_key = f"documents/{timestamp}/{unique_id}_{filename}"
+        if s3_key is None:
+            s3_key = generate_s3_key(filename)
 
-        # Upload file to S3
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=file_content,
-            ContentType=content_type,
-            Metadata={
-                "original_filename": filename,
-                "upload_timestamp": datetime.now().isoformat(),
+        # Upload via the transfer manager: multipart + threads over 8MB
+        body = (
+            io.BytesIO(file_content) if isinstance(file_content, bytes) else file_content
+        )
+        s3_client.upload_fileobj(
+            body,
+            S3_BUCKET_NAME,
+            s3_key,
+            ExtraArgs={
+                "ContentType": content_type,
+                "Metadata": {
+                    "original_filename": filename,
+                    "upload_timestamp": upload_timestamp or datetime.now().isoformat(),
+                },
             },
+            Config=S3_TRANSFER_CONFIG,
         )
 
         # Generate URL for the uploaded file
-        s3_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}"
+        s3_url = s3_url_for_key(s3_key)
 
         logger.info(f"File uploaded to S3: {s3_url}")
         return s3_url
@@ -144,15 +346,303 @@ def upload_file_to_s3(file_content: bytes, filename: str, content_type: str) ->
         raise e
 
 
-# File readers for different formats
+class AsyncGeminiEmbedder:
+    """Bounded async wrapper around the Gemini embedding model.
+
+    Packs texts greedily up to a payload budget under Gemini's 4 MiB
+    per-request cap and retries 429s with exponential backoff + jitter.
+    """
+
+    def __init__(
+        self, model, max_concurrency: int = 8, max_batch_bytes: int = 3_000_000
+    ):
+        self._model = model
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_batch_bytes = max_batch_bytes
+
+    def _pack(self, texts: List[str]) -> List[List[str]]:
+        """Group texts into batches that stay under the payload budget"""
+        batches = []
+        batch: List[str] = []
+        batch_bytes = 0
+        for text in texts:
+            size = len(text.encode("utf-8"))
+            if batch and batch_bytes + size > self._max_batch_bytes:
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(text)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @retry(
+        wait=wait_exponential_jitter(initial=1, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type(ResourceExhausted),
+        reraise=True,
+    )
+    async def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        async with self._semaphore:
+            return await self._model.aget_text_embedding_batch(batch)
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        results = await asyncio.gather(
+            *[self._embed_batch(batch) for batch in self._pack(texts)]
+        )
+        return [embedding for batch in results for embedding in batch]
+
+
+async_embedder = AsyncGeminiEmbedder(embed_model)
+
+
+# Chunk hygiene: headers, footers, TOCs and page numbers waste Gemini calls
+# and Pinecone slots and add recall noise
+MIN_CHUNK_WORDS = 20
+PAGE_NUMBER_RE = re.compile(
+    r"^\s*(?:page\s+)?\d+(?:\s+of\s+\d+)?\s*$", re.IGNORECASE | re.MULTILINE
+)
+MULTI_SPACE_RE = re.compile(r"[ \t]{2,}")
+
+
+def clean_document_text(text: str) -> str:
+    """Strip page-number lines and collapse runs of whitespace before chunking"""
+    text = PAGE_NUMBER_RE.sub("", text)
+    return MULTI_SPACE_RE.sub(" ", text)
+
+
+def filter_boilerplate_nodes(nodes):
+    """Drop tiny chunks and near-duplicates (same text modulo case/whitespace)"""
+    kept = []
+    seen = set()
+    for node in nodes:
+        text = node.get_content()
+        if len(text.split()) < MIN_CHUNK_WORDS:
+            continue
+        signature = hashlib.blake2b(
+            " ".join(text.lower().split()).encode("utf-8"), digest_size=8
+        ).digest()
+        if signature in seen:
+            continue
+        seen.add(signature)
+        kept.append(node)
+    return kept
+
+
+# S3 prefix for the extracted chunk-text blobs referenced by Pinecone metadata
+CHUNK_TEXT_PREFIX = "chunks"
+
+
+def fetch_chunk_text(metadata: Dict[str, Any]) -> str:
+    """Fetch one chunk's text from its S3 byte range"""
+    offset = int(metadata["byte_offset"])
+    length = int(metadata["byte_length"])
+    response = s3_client.get_object(
+        Bucket=S3_BUCKET_NAME,
+        Key=metadata["s3_text_key"],
+        Range=f"bytes={offset}-{offset + length - 1}",
+    )
+    return response["Body"].read().decode("utf-8")
+
+
+async def hydrate_node_texts(nodes) -> List[str]:
+    """Fetch retrieved nodes' texts from S3 concurrently.
+
+    Vectors written before chunk text moved to S3 keep their inline text.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def one(node):
+        if "s3_text_key" in node.metadata:
+            return await loop.run_in_executor(EXECUTOR, fetch_chunk_text, node.metadata)
+        return node.text
+
+    return await asyncio.gather(*[one(node) for node in nodes])
+
+
+async def embed_and_upsert_nodes(nodes, doc_hash: str) -> None:
+    """Embed nodes in batches and upsert them to Pinecone with bounded concurrency.
+
+    Chunk text is written to a single S3 blob and each vector's metadata
+    carries only {s3_text_key, byte_offset, byte_length}, keeping per-vector
+    upsert bytes and Pinecone storage small.
+    """
+    loop = asyncio.get_running_loop()
+
+    # Texts for embedding, captured before the byte-range keys land in
+    # metadata; EMBED mode drops each node's excluded_embed_metadata_keys
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+
+    # Build the sidecar blob and annotate each node with its byte range
+    text_key = f"{CHUNK_TEXT_PREFIX}/{doc_hash}.txt"
+    blob_parts = []
+    offset = 0
+    for node in nodes:
+        data = node.get_content().encode("utf-8")
+        node.metadata["s3_text_key"] = text_key
+        node.metadata["byte_offset"] = offset
+        node.metadata["byte_length"] = len(data)
+        blob_parts.append(data)
+        offset += len(data)
+
+    def put_chunk_blob():
+        s3_client.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=text_key,
+            Body=b"".join(blob_parts),
+            ContentType="text/plain; charset=utf-8",
+        )
+
+    # Embedding and the blob upload are independent; run them together
+    embeddings, _ = await asyncio.gather(
+        async_embedder.embed(texts),
+        loop.run_in_executor(EXECUTOR, put_chunk_blob),
+    )
+
+    vectors = []
+    for node, embedding in zip(nodes, embeddings):
+        metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+        vectors.append({"id": node.node_id, "values": embedding, "metadata": metadata})
+
+    # Cap in-flight upserts to avoid Pinecone write backpressure
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPSERTS)
+
+    async def upsert_batch(batch):
+        async with semaphore:
+            await async_index.upsert(vectors=batch)
+
+    await asyncio.gather(
+        *[
+            upsert_batch(vectors[i : i + UPSERT_BATCH_SIZE])
+            for i in range(0, len(vectors), UPSERT_BATCH_SIZE)
+        ]
+    )
+
+
+def load_pdf_documents(content: bytes) -> List[Document]:
+    """Parse PDF bytes with PyMuPDF, streaming one page at a time to keep memory O(page)"""
+    documents = []
+    with fitz.open(stream=content, filetype="pdf") as pdf:
+        for i, page in enumerate(pdf):
+            documents.append(
+                Document(text=page.get_text("text"), metadata={"page": i + 1})
+            )
+    return documents
+
+
+# describe_index_stats costs a full round-trip, so endpoints that only
+# report stats serve a value up to 10s stale
+STATS_TTL_SECONDS = 10
+_stats_cache = {"value": None, "expires": 0.0}
+
+
+async def get_index_stats_cached():
+    """Return index stats, refreshing from Pinecone at most every few seconds"""
+    now = time.monotonic()
+    if _stats_cache["value"] is None or now >= _stats_cache["expires"]:
+        _stats_cache["value"] = await async_index.describe_index_stats()
+        _stats_cache["expires"] = now + STATS_TTL_SECONDS
+    return _stats_cache["value"]
+
+
+@functools.lru_cache(maxsize=64)
+def get_retriever(
+    limit: int, filename: Optional[str] = None, file_type: Optional[str] = None
+):
+    """Cache one retriever per (top_k, filters) combination; read-thread-safe.
+
+    Filters push down to Pinecone's metadata index, so filtered queries
+    are evaluated inside the HNSW traversal instead of over-fetching.
+    """
+    filters = None
+    conditions = []
+    if filename:
+        conditions.append(ExactMatchFilter(key="filename", value=filename))
+    if file_type:
+        conditions.append(ExactMatchFilter(key="file_type", value=file_type))
+    if conditions:
+        filters = MetadataFilters(filters=conditions)
+    return index.as_retriever(similarity_top_k=limit, filters=filters)
+
+
+async def spool_upload(file: UploadFile, file_extension: str):
+    """Stream the upload in chunks, hashing incrementally.
+
+    Returns (content, tmp_path, digest): small uploads stay fully in memory
+    (content is bytes, tmp_path is None); larger ones are spilled to a temp
+    file (content is None, tmp_path is set). The caller owns the temp file.
+    """
+    hasher = hashlib.sha256()
+    buffer = bytearray()
+    tmp_file = None
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            if tmp_file is not None:
+                tmp_file.write(chunk)
+            else:
+                buffer.extend(chunk)
+                if len(buffer) > IN_MEMORY_MAX_BYTES:
+                    # Keep the extension: the path-based readers dispatch on it
+                    tmp_file = tempfile.NamedTemporaryFile(
+                        delete=False, suffix=file_extension
+                    )
+                    tmp_file.write(buffer)
+                    buffer = bytearray()
+    except Exception:
+        if tmp_file is not None:
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+        raise
+
+    if tmp_file is not None:
+        tmp_file.close()
+        return None, tmp_file.name, hasher.hexdigest()
+    return bytes(buffer), None, hasher.hexdigest()
+
+
+def parse_document_file(file_path: str, file_extension: str) -> List[Document]:
+    """Parse an on-disk upload into documents without pulling it into the heap"""
+    if file_extension == ".pdf":
+        documents = []
+        with fitz.open(file_path) as pdf:
+            for i, page in enumerate(pdf):
+                documents.append(
+                    Document(text=page.get_text("text"), metadata={"page": i + 1})
+                )
+        return documents
+    return readers[file_extension].load_data(file=file_path)
+
+
+def parse_document_bytes(content: bytes, file_extension: str) -> List[Document]:
+    """Parse uploaded bytes into documents, avoiding a disk round-trip where possible"""
+    if file_extension == ".pdf":
+        return load_pdf_documents(content)
+
+    # The remaining readers (Docx/Unstructured/Markdown) only accept an
+    # on-disk path
+    reader = readers[file_extension]
+    with tempfile.NamedTemporaryFile(suffix=file_extension) as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        return reader.load_data(file=tmp_file.name)
+
+
+# File readers for different formats. PDFs are parsed directly through
+# fitz in parse_document_bytes/parse_document_file; the entry here only
+# marks the extension as supported
 readers = {
-    ".pdf": PDFReader(),
+    ".pdf": None,
     ".docx": DocxReader(),
     ".txt": UnstructuredReader(),
     ".md": MarkdownReader(),
     ".xlsx": UnstructuredReader(),
 }
 
+# Precomputed for the per-request extension check
+SUPPORTED_EXTS = frozenset(readers)
+
 
 # Pydantic models
 class DocumentResponse(BaseModel):
@@ -182,106 +672,231 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics.
+
+    With multiple uvicorn workers, set PROMETHEUS_MULTIPROC_DIR (the
+    entrypoint does) so scrapes aggregate across processes; without it the
+    numbers are per-worker and the stage=... ms=... logs are the aggregate
+    source of truth.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(
+            content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST
+        )
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
     case_id: str = Form(...),
     case_document_id: Optional[str] = Form(None),
 ):
+    tmp_path = None
     try:
         # Validate file type
         file_extension = Path(file.filename).suffix.lower()
-        if file_extension not in readers:
+        if file_extension not in SUPPORTED_EXTS:
             raise HTTPException(
                 status_code=400,
-                detail=f"Unsupported file type. Supported: {list(readers.keys())}",
+                detail=f"Unsupported file type. Supported: {sorted(SUPPORTED_EXTS)}",
+            )
+
+        # Stream the body in chunks, hashing as we go; large uploads land in
+        # a temp file instead of the heap
+        content, tmp_path, doc_hash = await spool_upload(file, file_extension)
+
+        loop = asyncio.get_running_loop()
+
+        # Dedupe: if this exact file is already fully ingested in the case,
+        # skip the re-embed + re-upsert entirely. Vectors alone don't prove
+        # completeness (the S3 leg is allowed to fail, and a partial ingest
+        # may have left some batches behind), so only short-circuit when the
+        # stored source file is verifiably present; otherwise re-ingest and
+        # let the deterministic IDs overwrite whatever survived
+        existing = await async_index.query(
+            vector=[0.0] * embedding_dim,
+            filter={
+                "doc_hash": {"$eq": doc_hash},
+                "case_id": {"$eq": case_id},
+            },
+            top_k=1,
+            include_metadata=True,
+        )
+        if existing.matches:
+            match_meta = existing.matches[0].metadata
+            stored_key = match_meta.get("s3_key")
+            if stored_key and await loop.run_in_executor(
+                EXECUTOR, s3_object_exists, stored_key
+            ):
+                logger.info(
+                    f"Duplicate upload for {file.filename} (doc_hash={doc_hash}); skipping re-ingest"
+                )
+                return ORJSONResponse(
+                    status_code=200,
+                    content={
+                        "message": "File already processed; duplicate upload skipped",
+                        "filename": file.filename,
+                        "case_id": case_id,
+                        "case_document_id": case_document_id,
+                        "doc_hash": doc_hash,
+                        "s3_url": match_meta.get("s3_url"),
+                        "duplicate": True,
+                    },
+                )
+            logger.warning(
+                f"Incomplete prior ingest for {file.filename} (doc_hash={doc_hash}); re-ingesting"
             )
 
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=file_extension
-        ) as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
-
-        try:
-            # Read and parse the document
-            reader = readers[file_extension]
-            documents = reader.load_data(file=tmp_file_path)
-
-            # Add metadata to documents
-            for doc in documents:
-                doc.metadata["filename"] = file.filename
-                doc.metadata["file_type"] = file_extension
-                doc.metadata["upload_timestamp"] = datetime.now().isoformat()
-                doc.metadata["case_id"] = case_id
-                if case_document_id:
-                    doc.metadata["case_document_id"] = case_document_id
-
-            # Parse documents into nodes/chunks
-            nodes = node_parser.get_nodes_from_documents(documents)
-
-            logger.info(f"Created {len(nodes)} chunks from {len(documents)} documents")
-
-            # Insert nodes into existing index
-            index.insert_nodes(nodes)
-
-            # Verify insertion by checking Pinecone stats
-            stats = pinecone_index.describe_index_stats()
-            logger.info(f"Pinecone index stats after insertion: {stats}")
-
-            logger.info(
-                f"Successfully processed and stored {len(documents)} documents from {file.filename}"
+        # Parse the upload off the event loop
+        with timed("parse"):
+            if content is not None:
+                documents = await loop.run_in_executor(
+                    EXECUTOR, parse_document_bytes, content, file_extension
+                )
+            else:
+                documents = await loop.run_in_executor(
+                    EXECUTOR, parse_document_file, tmp_path, file_extension
+                )
+
+        # Commit to an S3 destination up front so the URL can live in vector
+        # metadata and be served on duplicate uploads
+        s3_key = generate_s3_key(file.filename)
+
+        # Add metadata to documents (single timestamp shared across docs and S3)
+        now_iso = datetime.now().isoformat()
+        for doc in documents:
+            doc.set_content(clean_document_text(doc.get_content()))
+            doc.metadata["filename"] = file.filename
+            doc.metadata["file_type"] = file_extension
+            doc.metadata["upload_timestamp"] = now_iso
+            doc.metadata["case_id"] = case_id
+            doc.metadata["doc_hash"] = doc_hash
+            doc.metadata["s3_key"] = s3_key
+            doc.metadata["s3_url"] = s3_url_for_key(s3_key)
+            # Operational metadata is identical across a document's chunks;
+            # keep it out of the embedded text so it can't skew similarity
+            doc.excluded_embed_metadata_keys = [
+                "doc_hash",
+                "s3_key",
+                "s3_url",
+                "upload_timestamp",
+            ]
+            if case_document_id:
+                doc.metadata["case_document_id"] = case_document_id
+
+        # Parse documents into nodes/chunks off the event loop
+        with timed("chunk"):
+            nodes = await loop.run_in_executor(
+                EXECUTOR, node_parser.get_nodes_from_documents, documents
             )
 
-            # Upload file to S3 after successful Pinecone processing
-            s3_url = None
-            s3_error = None
+        # Skip boilerplate before it costs embedding calls and index slots
+        total_chunks = len(nodes)
+        nodes = filter_boilerplate_nodes(nodes)
+
+        # Deterministic IDs keyed on case + content so retried upserts
+        # overwrite in place instead of duplicating vectors. The case scope
+        # matters: dedupe is per-case, so the same file in two cases must
+        # not share vector IDs or the second upload would steal the first
+        # case's vectors. The index is zero-padded because /documents
+        # reassembles chunk order by lexicographic sort on these IDs
+        for i, node in enumerate(nodes):
+            node.node_id = f"{case_id}:{doc_hash}:{i:05d}"
+
+        logger.info(
+            f"Created {len(nodes)} chunks from {len(documents)} documents "
+            f"({total_chunks - len(nodes)} boilerplate chunks dropped)"
+        )
+
+        # Pinecone ingest and S3 upload are independent after chunking,
+        # so run them concurrently
+        def s3_task():
+            with timed("s3"):
+                content_type = file.content_type or "application/octet-stream"
+                if content is not None:
+                    return upload_file_to_s3(
+                        content, file.filename, content_type, now_iso, s3_key
+                    )
+                # Stream large uploads from disk so S3 never sees the full heap copy
+                with open(tmp_path, "rb") as body:
+                    return upload_file_to_s3(
+                        body, file.filename, content_type, now_iso, s3_key
+                    )
+
+        async def ingest_task():
+            with timed("embed_upsert"):
+                await embed_and_upsert_nodes(nodes, doc_hash)
+
+        s3_url = None
+        s3_error = None
+        ingest_result, s3_result = await asyncio.gather(
+            ingest_task(),
+            loop.run_in_executor(EXECUTOR, s3_task),
+            return_exceptions=True,
+        )
+
+        if isinstance(ingest_result, BaseException):
+            # Remove whatever batches made it in, so a retry isn't rejected
+            # as a duplicate of a half-indexed document
             try:
-                s3_url = upload_file_to_s3(
-                    content,
-                    file.filename,
-                    file.content_type or "application/octet-stream",
-                )
-                logger.info(f"File successfully uploaded to S3: {s3_url}")
-            except Exception as s3_e:
-                s3_error = str(s3_e)
+                await async_index.delete(ids=[node.node_id for node in nodes])
+            except Exception as cleanup_e:
                 logger.error(
-                    f"S3 upload failed, but Pinecone processing succeeded: {s3_error}"
+                    f"Failed to clean up partial ingest for doc_hash={doc_hash}: {str(cleanup_e)}"
                 )
+            raise ingest_result
 
-            response_content = {
-                "message": "File uploaded and processed successfully",
-                "filename": file.filename,
-                "case_id": case_id,
-                "case_document_id": case_document_id,
-                "documents_processed": len(documents),
-                "chunks_created": len(nodes),
-                "file_type": file_extension,
-                "s3_url": s3_url,
-            }
-
-            # Add warning if S3 upload failed
-            if s3_error:
-                response_content["warning"] = (
-                    f"Document processed successfully but S3 upload failed: {s3_error}"
-                )
-                response_content["s3_error"] = s3_error
+        if isinstance(s3_result, BaseException):
+            s3_error = str(s3_result)
+            logger.error(
+                f"S3 upload failed, but Pinecone processing succeeded: {s3_error}"
+            )
+        else:
+            s3_url = s3_result
+            logger.info(f"File successfully uploaded to S3: {s3_url}")
 
-            return JSONResponse(
-                status_code=200,
-                content=response_content,
+        logger.info(
+            f"Successfully processed and stored {len(documents)} documents from {file.filename}"
+        )
+
+        response_content = {
+            "message": "File uploaded and processed successfully",
+            "filename": file.filename,
+            "case_id": case_id,
+            "case_document_id": case_document_id,
+            "documents_processed": len(documents),
+            "chunks_created": len(nodes),
+            "file_type": file_extension,
+            "doc_hash": doc_hash,
+            "s3_url": s3_url,
+        }
+
+        # Add warning if S3 upload failed
+        if s3_error:
+            response_content["warning"] = (
+                f"Document processed successfully but S3 upload failed: {s3_error}"
             )
+            response_content["s3_error"] = s3_error
 
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
+        return ORJSONResponse(
+            status_code=200,
+            content=response_content,
+        )
 
     except Exception as e:
         logger.error(f"Error processing file {file.filename}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
 
+    finally:
+        # Clean up the spooled temp file for large uploads
+        if tmp_path is not None:
+            os.unlink(tmp_path)
+
 
 @app.get("/documents", response_model=DocumentsResponse)
 async def get_documents(
@@ -311,11 +926,7 @@ async def get_documents(
         # )
 
         # Use vector store directly for metadata filtering
-        # Get embedding dimension from test embedding
-        test_embedding = embed_model.get_text_embedding("test")
-        embedding_dim = len(test_embedding)
-
-        vector_results = pinecone_index.query(
+        vector_results = await async_index.query(
             vector=[0.0] * embedding_dim,  # Dummy vector with correct dimension
             filter=filter_dict,
             top_k=10000,
@@ -331,19 +942,30 @@ async def get_documents(
                 markdown_content="# No documents found\n\nNo documents found for the specified case ID.",
             )
 
+        # Chunk text lives in S3 byte ranges; fetch all of them concurrently
+        loop = asyncio.get_running_loop()
+
+        async def match_text(match):
+            if "s3_text_key" in match.metadata:
+                return await loop.run_in_executor(
+                    EXECUTOR, fetch_chunk_text, match.metadata
+                )
+            # Pre-migration vectors still carry inline text in metadata
+            return match.metadata.get("_node_content", match.metadata.get("text", ""))
+
+        match_texts = await asyncio.gather(
+            *[match_text(match) for match in vector_results.matches]
+        )
+
         # Group chunks by filename
         documents_by_filename = {}
-        for match in vector_results.matches:
+        for match, text_content in zip(vector_results.matches, match_texts):
             metadata = match.metadata
             filename = metadata.get("filename", "Unknown")
 
             if filename not in documents_by_filename:
                 documents_by_filename[filename] = {"chunks": [], "metadata": metadata}
 
-            # Text content should be in the metadata under '_node_content' or similar
-            # LlamaIndex typically stores the text content in metadata
-            text_content = metadata.get("_node_content", metadata.get("text", ""))
-
             documents_by_filename[filename]["chunks"].append(
                 {"text": text_content, "score": match.score, "id": match.id}
             )
@@ -395,6 +1017,10 @@ async def get_documents(
 async def query_documents(
     q: str = Query(..., description="Search query"),
     limit: int = Query(10, ge=1, le=50, description="Number of results to return"),
+    filename: Optional[str] = Query(None, description="Filter results by filename"),
+    file_type: Optional[str] = Query(
+        None, description="Filter results by file extension, e.g. .pdf"
+    ),
 ):
     """Query documents using similarity search"""
     try:
@@ -404,15 +1030,20 @@ async def query_documents(
         # )
 
         # Get nodes instead of response
-        retriever = index.as_retriever(similarity_top_k=limit)
-        nodes = retriever.retrieve(q)
+        retriever = get_retriever(limit, filename=filename, file_type=file_type)
+        nodes = await asyncio.get_running_loop().run_in_executor(
+            EXECUTOR, retriever.retrieve, q
+        )
+
+        # Pull the chunk texts back from their S3 byte ranges
+        texts = await hydrate_node_texts(nodes)
 
         results = []
-        for node in nodes:
+        for node, text in zip(nodes, texts):
             results.append(
                 {
                     "id": node.node_id,
-                    "text": node.text,
+                    "text": text,
                     "score": node.score,
                     "metadata": node.metadata,
                 }
@@ -432,7 +1063,7 @@ async def list_chunks(limit: int = Query(100, ge=1, le=1000)):
     """List all document chunks in the index"""
     try:
         # Get all vectors from Pinecone (this is a basic implementation)
-        stats = pinecone_index.describe_index_stats()
+        stats = await get_index_stats_cached()
 
         # For a more detailed listing, we'd need to implement pagination
         # This is a simplified version showing stats
@@ -452,7 +1083,7 @@ async def list_chunks(limit: int = Query(100, ge=1, le=1000)):
 async def get_index_stats():
     """Get Pinecone index statistics"""
     try:
-        stats = pinecone_index.describe_index_stats()
+        stats = await get_index_stats_cached()
 
         # Convert to JSON-serializable format
         serializable_stats = {
@@ -483,4 +1114,11 @@ async def get_index_stats():
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count(),
+        loop="uvloop",
+        http="httptools",
+    )